@@ -5,14 +5,18 @@ import subprocess
 import sys
 import os
 import json
+import gzip
+import tempfile
+import glob
+import stat
 import importlib
+from importlib import metadata
+from operator import itemgetter
 from datetime import datetime, timezone
+from html import escape
 from zoneinfo import ZoneInfo
+import time
 import asyncio
-import aiohttp
-import aiofiles
-from aiohttp import web
-
 
 # Activating the virtual environment.
 DOSSIER_VENV = ".venv"
@@ -25,6 +29,7 @@ def verif_dependances(fichier_requirements="requirements.txt"):
     """
     Checks and installs the dependencies listed in requirements.txt in the current Python environment.
     Handles read or installation errors without interrupting the program.	
+    The installed packages are checked from their metadata, without importing them.
     """
 
     if not os.path.exists(fichier_requirements):
@@ -43,32 +48,61 @@ def verif_dependances(fichier_requirements="requirements.txt"):
     except Exception as e:
         print(f"[Avertissement] Impossible de mettre à jour pip : {e}")
 
+    installes = {(d.metadata["Name"] or "").lower().replace("_", "-") for d in metadata.distributions()}
     for package in packages:
         nom_module = package.split("==")[0]
-        try:
-            importlib.import_module(nom_module)
-        except ImportError:
+        if nom_module.lower().replace("_", "-") not in installes:
             print(f"[Info] Installation automatique de {package}...")
             try:
                 subprocess.check_call([sys.executable, "-m", "pip", "install", package])
             except Exception as e:
                 print(f"[Erreur] Impossible d’installer {package} : {e}")
+    importlib.invalidate_caches()
+
+# Dependency check, only when requested (TN3_BOOTSTRAP=1 or --bootstrap).
+# It runs before the third-party imports below, so it can install them on the first run.
+if __name__ == "__main__" and (os.environ.get("TN3_BOOTSTRAP") == "1" or "--bootstrap" in sys.argv):
+    verif_dependances()
+
+import aiohttp
+from aiohttp import web
+
+# orjson is optional, the standard json module is used as a fallback.
+try:
+    import orjson as _json_fast
+except ImportError:
+    _json_fast = None
 
 def verif_dossier():
     """ A function that allows you to check for the existence of the data folder and creates it if necessary.
+    The check is only done once, the folder is then assumed to exist.
     """
 
+    global _DIR_READY
+    if _DIR_READY:
+        return
     os.makedirs(DOSSIER_DONNEES, exist_ok=True)
+    _DIR_READY = True
 
-async def chargement_tremblements():
+async def chargement_tremblements(session):
     """ Function that allows you to retrieve earthquake data from the website.
+    The HTTP session is shared by the application and reused between updates.
     """
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(URL_USGS, timeout=15) as reponse:
-                reponse.raise_for_status()
-                return await reponse.json()
+        async with session.get(URL_USGS) as reponse:
+            if reponse.status >= 400:
+                raise aiohttp.ClientResponseError(
+                    reponse.request_info,
+                    reponse.history,
+                    status=reponse.status,
+                    message=reponse.reason,
+                    headers=reponse.headers
+                )
+            contenu = await reponse.read()
+            if _json_fast:
+                return _json_fast.loads(contenu)
+            return json.loads(contenu)
     except aiohttp.ClientConnectionError:
         print("Erreur : impossible de se connecter au serveur.")
     except aiohttp.ClientResponseError as e:
@@ -79,36 +113,97 @@ async def chargement_tremblements():
         print(f"Erreur inattendue pendant le téléchargement : {e}")
     return None
 
+def ecriture_octets(chemin, contenu):
+    """ Function that writes bytes to a file in a single call.
+    The bytes go to a temporary file first, which then replaces the target, so an interrupted write never leaves a corrupt file.
+    Each save uses its own temporary file, so two saves at the same time can't write into the same one.
+    The permissions of the existing file, or the default ones from the umask, are kept.
+    """
+
+    try:
+        mode = stat.S_IMODE(os.stat(chemin).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+
+    descripteur, chemin_temp = tempfile.mkstemp(
+        dir=os.path.dirname(chemin),
+        prefix=os.path.basename(chemin) + ".",
+        suffix=".tmp"
+    )
+    try:
+        with os.fdopen(descripteur, "wb") as f:
+            f.write(contenu)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(chemin_temp, mode)
+        os.replace(chemin_temp, chemin)
+    except BaseException:
+        try:
+            os.remove(chemin_temp)
+        except OSError:
+            pass
+        raise
+
+def nettoyage_temporaires():
+    """ Function that removes the temporary files left in the data folder by an interrupted save.
+    """
+
+    for chemin_temp in glob.glob(glob.escape(FICHIER_DONNEES) + ".*.tmp"):
+        try:
+            os.remove(chemin_temp)
+        except OSError as e:
+            print(f"[Avertissement] Impossible de supprimer {chemin_temp} : {e}")
+
+def lecture_octets(chemin):
+    """ Function that reads a whole file as bytes in a single call.
+    """
+
+    with open(chemin, "rb") as f:
+        return f.read()
+
 async def sauvegarde_json(donnees):
     """ This function saves the data to a JSON file. The file is created if it does not already exist.
+    The list of events shown on the web page is rebuilt from the new data.
     """
     
-    verif_dossier()
-    async with aiofiles.open(FICHIER_DONNEES, "w") as f:
-        await f.write(json.dumps(donnees, indent=2))
+    if _json_fast:
+        contenu = _json_fast.dumps(donnees, option=_json_fast.OPT_INDENT_2)
+    else:
+        contenu = json.dumps(donnees, indent=2).encode("utf-8")
+    await asyncio.to_thread(ecriture_octets, FICHIER_DONNEES, contenu)
+    reconstruction_evenements(donnees)
+    invalidation_cache()
+
+def invalidation_cache():
+    """ Function that empties the web page cache after the data has changed.
+    """
+
+    global _cache_version
+    _cache_version += 1
+    _page_cache.clear()
 
 async def chargement_json():
     """ This function loads data from a JSON file.
-	It returns an empty structure if the file doesn't exist or if the JSON is invalid.
+	It returns an empty structure if the file doesn't exist or can't be read.
     """
 
     try:
-        async with aiofiles.open(FICHIER_DONNEES, "r") as f:
-            contenu = await f.read()
-            return json.loads(contenu)
-    except json.JSONDecodeError:
-        print("[Erreur] Format JSON invalide.")
-        return {"features": []}
+        contenu = await asyncio.to_thread(lecture_octets, FICHIER_DONNEES)
+        if _json_fast:
+            return _json_fast.loads(contenu)
+        return json.loads(contenu)
     except Exception as e:
         print(f"[Erreur] Impossible de lire le fichier : {e}")
         return {"features": []}
 
 def extract_evenements(evenement):
     """ A function that allows you to extract JSON data and separate it properly.
+    The sort keys are normalized and the HTML fields escaped here once, so the web page does not have to do it on each request.
     """
     
     propriete = evenement.get("properties", {})
     marque_temps = propriete.get("time")
+    endroit = propriete.get("place") or "Unknown"
     
     if marque_temps:
         date_temps = datetime.fromtimestamp(marque_temps / 1000)
@@ -117,144 +212,145 @@ def extract_evenements(evenement):
         moment_str = ""
     
     return {
-        "endroit": propriete.get("place", "Unknown"),
         "magnitude": propriete.get("mag", 0),
         "moment": moment_str,
-        "url": propriete.get("url", "")
+        "endroit_html": escape(endroit),
+        "url_html": escape(propriete.get("url") or "", quote=True),
+        "_mag_key": propriete.get("mag") or 0.0,
+        "_place_key": endroit.lower(),
+        "_time_key": marque_temps or 0
     }
 
+def reconstruction_evenements(donnees):
+    """ Function that extracts and filters the events once per update, so the web page does not have to.
+    """
+
+    global EVENEMENTS_PRETS
+    evenements = (extract_evenements(e) for e in donnees.get("features", []))
+    EVENEMENTS_PRETS = [e for e in evenements if e["magnitude"] and e["magnitude"] > 0.1]
+
 def trie_evenements(evenements, trier_par="magnitude", ordre="descendant"):
     """ Function that allows you to sort the data for display in the table.
     """
 
     inverse = (ordre == "descendant")
     key_map = {
-        "magnitude": lambda e: e["magnitude"] or 0,
-        "endroit": lambda e: e["endroit"] or "",
-        "moment": lambda e: e["moment"] or ""
+        "magnitude": itemgetter("_mag_key"),
+        "endroit": itemgetter("_place_key"),
+        "moment": itemgetter("_time_key")
     }
     fonction_cle = key_map.get(trier_par, key_map["magnitude"])
     return sorted(evenements, key=fonction_cle, reverse=inverse)
 
+def accepte_gzip(entete):
+    """ Function that reads the Accept-Encoding header and tells if gzip is accepted.
+    An explicit gzip entry takes precedence over "*", and a quality of 0 means refused.
+    """
+
+    qualites = {}
+    for element in entete.split(","):
+        nom, *parametres = element.split(";")
+        qualite = 1.0
+        for parametre in parametres:
+            cle, _, valeur = parametre.strip().partition("=")
+            if cle.lower() == "q":
+                try:
+                    qualite = float(valeur)
+                except ValueError:
+                    qualite = 0.0
+        qualites[nom.strip().lower()] = qualite
+
+    qualite = qualites.get("gzip", qualites.get("*", 0.0))
+    return qualite > 0
+
+def reponse_page(requete, entree):
+    """ Function that sends the web page, compressed with gzip when the browser accepts it.
+    """
+
+    if accepte_gzip(requete.headers.get("Accept-Encoding", "")):
+        return web.Response(body=entree["gzip"], headers=ENTETES_GZIP)
+    return web.Response(body=entree["brut"], content_type="text/html", charset="utf-8", headers={"Vary": "Accept-Encoding"})
+
 async def page_web(requete):
     """ A function that allows the web page to be built properly.
+    The page and its gzip version are built once per update and kept in the cache.
     """
 
     trier_par = requete.query.get("tri", "moment")
     ordre = requete.query.get("ordre", "descendant")
-    donnees = await chargement_json()
 
-    evenements = list(map(extract_evenements, donnees.get("features", [])))
-    evenements = list(filter(lambda e: e['magnitude'] > 0.1, evenements))
-    evenements = trie_evenements(evenements, trier_par=trier_par, ordre=ordre)
+    # Unknown values get the same fallbacks as trie_evenements, so every request hits one of the six cache keys.
+    if trier_par not in COLONNES_TRI:
+        trier_par = "magnitude"
+    if ordre not in ORDRES_TRI:
+        ordre = "ascendant"
+    cle_cache = (trier_par, ordre, _cache_version)
+    entree = _page_cache.get(cle_cache)
+    if entree is not None:
+        return reponse_page(requete, entree)
+
+    evenements = trie_evenements(EVENEMENTS_PRETS, trier_par=trier_par, ordre=ordre)
     inverser_ordre = lambda col: "ascendant" if trier_par == col and ordre == "descendant" else "descendant"
 
-    html_rows = [
-        f"<tr><td>{e['magnitude']}</td><td>{e['endroit']}</td><td>{e['moment']}</td>"
-        f"<td><a href='{e['url']}' target='_blank'>Liens vers earthquake.usgs.gov</a></td></tr>"
+    html_rows = "".join(
+        MODELE_LIGNE(e["magnitude"], e["endroit_html"], e["moment"], e["url_html"])
         for e in evenements
-    ]
-
-    html = f"""
-    <html>
-    <head>
-        <title>Tremblements de terre mondiaux</title>
-        <meta http-equiv="refresh" content="3600">
-        <style>
-            table {{ border-collapse: collapse; width: 100%; }}
-            th, td {{ border: 1px solid black; padding: 5px; text-align: left; }}
-            th a {{ text-decoration: none; color: black; }}
-        </style>
-    </head>
-    <body>
-        <h1>🌎 Tremblements de terre mondiaux (dans les 24 dernières heures) 🌎</h1>
-        <p>Nombre total d'évènements: {len(evenements)}</p>
-        <button onclick="location.href='/update'" style="display: block; margin-bottom: 20px;">Mettre à jour</button>
-        <label for="entree_recherche">Recherche rapide:</label>
-        <input type="text" id="entree_recherche" placeholder="Écrire ici pour chercher...">
-        <select id="selection_colonne">
-            <option value="1" selected>Endroit</option>
-            <option value="0">Magnitude</option>
-            <option value="2">Moment</option>
-        </select>
-        <table>
-            <tr>
-                <th><a href='/?tri=magnitude&ordre={inverser_ordre("magnitude")}'>Magnitude</a></th>
-                <th><a href='/?tri=endroit&ordre={inverser_ordre("endroit")}'>Endroit</a></th>
-                <th><a href='/?tri=moment&ordre={inverser_ordre("moment")}'>Moment</a></th>
-                <th>Détails</th>
-            </tr>
-            {''.join(html_rows)}
-        </table>
-    <script>
-
-    // For searching within the table.
-    const entree_recherche = document.getElementById("entree_recherche");
-    const selection_colonne = document.getElementById("selection_colonne");
-    const tableau = document.querySelector("table");
-
-    entree_recherche.addEventListener("input", filtrer_tableau);
-    selection_colonne.addEventListener("change", filtrer_tableau);
-
-    function filtrer_tableau() {{
-        const terme = entree_recherche.value.toLowerCase();
-        const index_colonne = parseInt(selection_colonne.value);
-
-        const ligne = tableau.querySelectorAll("tr");
-        ligne.forEach((ligne, i) => {{
-            if(i === 0) return;
-            const cell = ligne.cells[index_colonne];
-            ligne.style.display = cell.textContent.toLowerCase().includes(terme) ? "" : "none";
-        }});
-    }}
-    </script>
-
-    </body>
-    </html>
-    """
-    return web.Response(text=html, content_type="text/html")
+    )
+
+    milieu = MODELE_MILIEU(
+        nombre=len(evenements),
+        ordre_magnitude=inverser_ordre("magnitude"),
+        ordre_endroit=inverser_ordre("endroit"),
+        ordre_moment=inverser_ordre("moment")
+    )
+    page = b"".join([ENTETE_HTML, milieu.encode("utf-8"), html_rows.encode("utf-8"), PIED_HTML])
+    entree = {"brut": page, "gzip": gzip.compress(page, compresslevel=6)}
+    _page_cache[cle_cache] = entree
+    return reponse_page(requete, entree)
 
 async def maj_manuelle(requete):
     """ Function that allows for manual data updates.
     """
 
-    print(f"[{datetime.now().strftime('%a %d %b %Y %H:%M:%S')}] Mise à jour manuelle déclenchée.")
-    donnees = await chargement_tremblements()
+    print(f"[{time.strftime('%a %d %b %Y %H:%M:%S')}] Mise à jour manuelle déclenchée.")
+    donnees = await chargement_tremblements(requete.app['http'])
     if donnees:
         await sauvegarde_json(donnees)
     else:
         print("Échec de la mise à jour manuelle : aucune donnée reçue.")
     raise web.HTTPFound("/")
 
-async def maj_auto():
+async def maj_auto(app):
     """ Function that allows for automatic data updates.
     """
 
     while True:
-        print(f"[{datetime.now().strftime('%a %d %b %Y %H:%M:%S')}] Mise à jour automatique des données...")
-        donnees = await chargement_tremblements()
+        print(f"[{time.strftime('%a %d %b %Y %H:%M:%S')}] Mise à jour automatique des données...")
+        donnees = await chargement_tremblements(app['http'])
         if donnees:
             await sauvegarde_json(donnees)
-            evenements = [extract_evenements(e) for e in donnees.get("features", []) if e.get("properties", {}).get("mag", 0) > 0.1]
-            print(f"[{datetime.now().strftime('%a %d %b %Y %H:%M:%S')}] Mise à jour terminée ({len(evenements)} évènements).")
+            print(f"[{time.strftime('%a %d %b %Y %H:%M:%S')}] Mise à jour terminée ({len(EVENEMENTS_PRETS)} évènements).")
         else:
             print("Aucune donnée reçue, tentative à la prochaine heure.")
         await asyncio.sleep(PERIODE_MAJ)
 
 async def demarrage_taches(app):
     """ Update startup function.
+    The local file is only read here, as a fallback until the website answers.
     """
 
+    app['http'] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
     donnees = await chargement_json()
-    nouvelles_donnees = await chargement_tremblements()
+    nouvelles_donnees = await chargement_tremblements(app['http'])
     if nouvelles_donnees:
         await sauvegarde_json(nouvelles_donnees)
-        donnees = nouvelles_donnees
+    else:
+        reconstruction_evenements(donnees)
     print(f"[{datetime.now(timezone.utc).isoformat()}] Chargement initial des données complété.")
-    app['maj_tache'] = asyncio.create_task(maj_auto())
+    app['maj_tache'] = asyncio.create_task(maj_auto(app))
 
 async def fermeture_taches(app):
-    """ Function to stop updates.
+    """ Function to stop updates and close the HTTP session.
     """
 
     tache = app.get('maj_tache')
@@ -267,10 +363,16 @@ async def fermeture_taches(app):
         except Exception as e:
             print(f"Erreur inattendue pendant la fermeture de la tâche : {e}")
 
+    session = app.get('http')
+    if session:
+        await session.close()
+
 async def initialisation():
     """ Initialization function.
     """
 
+    verif_dossier()
+    nettoyage_temporaires()
     app = web.Application()
     app.router.add_get("/", page_web)
     app.router.add_get("/update", maj_manuelle)
@@ -279,9 +381,6 @@ async def initialisation():
     app.on_cleanup.append(fermeture_taches)
     return app
 
-# Dependency check.
-verif_dependances()
-
 # Declaration of global constants and variables.
 DOSSIER_DONNEES = "Données"
 FICHIER_DONNEES = os.path.join(DOSSIER_DONNEES, "Tremblements_terre.json")
@@ -289,7 +388,92 @@ URL_USGS = "https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_day.ge
 PORT = 8080
 PERIODE_MAJ = 3600
 local_tz = ZoneInfo("America/Toronto")
+COLONNES_TRI = ("magnitude", "endroit", "moment")
+ORDRES_TRI = ("ascendant", "descendant")
+# Static parts of the web page, encoded once.
+ENTETE_HTML = """
+    <html>
+    <head>
+        <title>Tremblements de terre mondiaux</title>
+        <meta http-equiv="refresh" content="3600">
+        <style>
+            table { border-collapse: collapse; width: 100%; }
+            th, td { border: 1px solid black; padding: 5px; text-align: left; }
+            th a { text-decoration: none; color: black; }
+        </style>
+    </head>
+    <body>
+        <h1>🌎 Tremblements de terre mondiaux (dans les 24 dernières heures) 🌎</h1>
+""".encode("utf-8")
+MODELE_MILIEU = """
+        <p>Nombre total d'évènements: {nombre}</p>
+        <button onclick="location.href='/update'" style="display: block; margin-bottom: 20px;">Mettre à jour</button>
+        <label for="entree_recherche">Recherche rapide:</label>
+        <input type="text" id="entree_recherche" placeholder="Écrire ici pour chercher...">
+        <select id="selection_colonne">
+            <option value="1" selected>Endroit</option>
+            <option value="0">Magnitude</option>
+            <option value="2">Moment</option>
+        </select>
+        <table>
+            <tr>
+                <th><a href='/?tri=magnitude&ordre={ordre_magnitude}'>Magnitude</a></th>
+                <th><a href='/?tri=endroit&ordre={ordre_endroit}'>Endroit</a></th>
+                <th><a href='/?tri=moment&ordre={ordre_moment}'>Moment</a></th>
+                <th>Détails</th>
+            </tr>
+""".format
+PIED_HTML = """
+        </table>
+    <script>
+
+    // For searching within the table.
+    const entree_recherche = document.getElementById("entree_recherche");
+    const selection_colonne = document.getElementById("selection_colonne");
+    const tableau = document.querySelector("table");
+
+    entree_recherche.addEventListener("input", filtrer_tableau);
+    selection_colonne.addEventListener("change", filtrer_tableau);
+
+    function filtrer_tableau() {
+        const terme = entree_recherche.value.toLowerCase();
+        const index_colonne = parseInt(selection_colonne.value);
+
+        const ligne = tableau.querySelectorAll("tr");
+        ligne.forEach((ligne, i) => {
+            if(i === 0) return;
+            const cell = ligne.cells[index_colonne];
+            ligne.style.display = cell.textContent.toLowerCase().includes(terme) ? "" : "none";
+        });
+    }
+    </script>
+
+    </body>
+    </html>
+    """.encode("utf-8")
+MODELE_LIGNE = (
+    "<tr><td>{}</td><td>{}</td><td>{}</td>"
+    "<td><a href='{}' target='_blank'>Liens vers earthquake.usgs.gov</a></td></tr>"
+).format
+ENTETES_GZIP = {
+    "Content-Encoding": "gzip",
+    "Content-Type": "text/html; charset=utf-8",
+    "Vary": "Accept-Encoding"
+}
+EVENEMENTS_PRETS = []
+_DIR_READY = False
+
+# The umask can only be read by changing it, so it is read once here, before any save runs in a thread.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_page_cache = {}
+_cache_version = 0
 
 if __name__ == "__main__":
-    verif_dossier()
+    # uvloop is optional and not available on Windows, the default event loop is used otherwise.
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     web.run_app(initialisation(), port=PORT)
\ No newline at end of file